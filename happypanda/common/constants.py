@@ -18,6 +18,7 @@ dir_plugin = 'plugins'
 log_error = os.path.join(dir_log, "error.log")
 log_normal = os.path.join(dir_log, "activity.log")
 log_debug = os.path.join(dir_log, "debug.log")
+log_queue_size = 10000 # max log records waiting to be written, more are dropped
 db_name = "happypanda.db"
 db_name_debug = "happypanda_debug.db"
 db_path = os.path.join(dir_root, dir_data, db_name)
@@ -52,9 +53,13 @@ local_port = 5577
 web_port = local_port + 1
 localhost = False # localhost only
 host = "localhost" if localhost else ""
-client_limit = None
+client_limit = None # max connected clients, each client uses two greenlets (receiving and dispatching)
+server_workers = 1 # amount of server processes, 0 for one per cpu
 postfix = b'end'
 data_size = 1024
+socket_buffer_size = None # SO_RCVBUF/SO_SNDBUF size of client sockets, None to use the OS default
+max_frame_size = 10 * 1024 * 1024 # max size in bytes of a single client message
+client_inflight = 16 # max messages queued per client before receiving pauses
 public_server = False
 server_ready = True
 
@@ -211,8 +211,9 @@ class JSONParseError(ClientError, ServerError):
 
     def __init__(self, json_data, name, msg):
         """init func."""
-        pass
-        # TODO: init both classs. log json_data.
+        # the message is sent back as is, without ClientError's "error occured in client" wrapping
+        CoreError.__init__(self, name, msg)
+        log_d("Invalid json data: %r", json_data)
 
 @error_code(901)
 class InvalidMessage(ServerError):
@@ -10,14 +10,30 @@ from datetime import datetime
 from happypanda.common import constants, exceptions
 from happypanda.server.core import db
 
+try:
+    import orjson
+    _json_dumps = orjson.dumps # returns bytes
+except ImportError:
+    orjson = None
+
 def finalize(msg_dict, name=constants.server_name):
-    "Finalize dict message before sending"
+    """
+    Finalize dict message before sending
+    With orjson installed the output is compact and differs from json.dumps in a few cases:
+    NaN and Infinity are sent as null, and datetime objects are serialized instead of raising TypeError.
+    """
     enc = 'utf-8'
     msg = {
         'name':name,
         'data':msg_dict
         }
 
+    if orjson:
+        try:
+            # non-str keys are converted to str like json.dumps does
+            return _json_dumps(msg, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass # e.g. ints outside 64 bits, which json.dumps can handle
     return bytes(json.dumps(msg), enc)
 
 class CoreMessage:
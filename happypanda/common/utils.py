@@ -1,5 +1,9 @@
 import sys
 import json
+import atexit
+import logging
+import logging.handlers
+import queue
 import enum
 import os
 import socket
@@ -10,6 +14,19 @@ from inspect import ismodule
 
 from happypanda.common import constants, exceptions, upnp
 
+# use a C json decoder when available, they all accept bytes directly
+_json_loads_memoryview = False # if the decoder can read a memoryview without a copy
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_loads_memoryview = True
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        _json_loads = json.loads
+
 def eprint(*args, **kwargs):
     "Prints to stderr"
     print(*args, file=sys.stderr, **kwargs)
@@ -36,6 +53,40 @@ def setup_dirs():
     "Creates directories at the specified root path"
     pass
 
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    "Drops records when the queue is full instead of blocking or reporting an error"
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+_log_listener = None
+def setup_logger():
+    """
+    Configure the root logger
+    Records are put on a bounded queue and written out by a listener thread, so logging from
+    the server doesn't block on I/O. Calling this again returns the existing listener.
+    """
+    global _log_listener
+    if _log_listener:
+        return _log_listener
+
+    log_queue = queue.Queue(constants.log_queue_size)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG if constants.debug else logging.INFO)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+
+    listener.start()
+    atexit.register(listener.stop)
+    _log_listener = listener
+    return listener
+
 def get_argparser():
     "Creates and returns a command-line arguments parser"
     parser = argparse.ArgumentParser(prog="Happypanda X",
@@ -53,6 +104,9 @@ def get_argparser():
     parser.add_argument('--localhost', action='store_true',
                     help='Start servers on localhost')
 
+    parser.add_argument('--workers', type=int,
+                    help='Specify how many server processes to start, 0 for one per cpu (default: 1)')
+
     parser.add_argument('-d', '--debug', action='store_true',
                     help='Start in debug mode')
 
@@ -79,6 +133,8 @@ def parse_options(args):
         constants.local_port = args.port
     if args.web_port:
         constants.web_port = args.web_port
+    if args.workers is not None:
+        constants.server_workers = args.workers
 
 
 
@@ -116,12 +172,19 @@ def get_module_members(mod):
 
 ## SERVER ##
 def convert_to_json(buffer, name):
-    ""
+    """
+    Decode json data
+    Params:
+        buffer -- bytes-like object, postfix is stripped if present
+        name -- name to include in the error
+    """
     try:
-        if buffer.endswith(constants.postfix):
-            buffer = buffer[:-len(constants.postfix)].decode('utf-8') # slice 'end' off
-        json_data = json.loads(buffer)
-    except json.JSONDecodeError as e:
+        if isinstance(buffer, memoryview) and not _json_loads_memoryview:
+            buffer = buffer.tobytes()
+        if buffer[-len(constants.postfix):] == constants.postfix:
+            buffer = buffer[:-len(constants.postfix)] # slice 'end' off
+        json_data = _json_loads(buffer)
+    except ValueError as e: # all decoders raise a subclass of ValueError
         raise exceptions.JSONParseError(buffer, name, "Failed parsing json data: {}".format(e))
     return json_data
 
@@ -12,6 +12,7 @@ def start():
     parser = utils.get_argparser()
     args = parser.parse_args()
     utils.parse_options(args)
+    utils.setup_logger()
 
     constants.core_plugin = plugins._plugin_load("happypanda.server.core.coreplugin", "core")
     print(plugins.registered.init_plugins())
@@ -630,16 +630,27 @@ def check_db_version(sess):
     init_defaults(sess)
     return True
 
-def init(**kwargs):
+def _create_session():
+    "Bind constants.db_session to a new engine, returns the engine"
     db_path = constants.db_path_debug if constants.debug else constants.db_path
     Session = scoped_session(sessionmaker())
     constants.db_session = Session
     initEvents()
     engine = create_engine(os.path.join("sqlite:///", db_path))
-    Base.metadata.create_all(engine)
     Session.configure(bind=engine)
+    return engine
+
+def init(**kwargs):
+    engine = _create_session()
+    Base.metadata.create_all(engine)
+
+    return check_db_version(constants.db_session())
 
-    return check_db_version(Session())
+def connect():
+    """Connect to a database already set up by init.
+    Unlike init, this doesn't create the schema or record a start in the database.
+    Used by processes sharing the database with the one that called init, e.g. server workers"""
+    _create_session()
 
 def table_attribs(model, id = False):
     """Returns a dict of table column names and their SQLAlchemy value objects
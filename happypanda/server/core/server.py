@@ -1,6 +1,13 @@
 ﻿import json
+import logging
+import os
+import signal
+import time
+import itertools
+import weakref
+import types
 
-from inspect import getmembers, isfunction
+import gevent
 
 from gevent import socket, pool, queue
 from gevent.server import StreamServer
@@ -10,12 +17,57 @@ from happypanda.server import interface
 from happypanda.server.core import db
 from happypanda.webclient import main as hweb
 
-_special_functions = ('interactive',) # functions we don't consider as part of the api
+log = logging.getLogger(__name__)
+log_i = log.info
+log_d = log.debug
+
+_function_keys = ('fname',) # keys of a function message that are not function arguments
+
+def _arg_names(func):
+    "Returns a frozenset of the argument names func accepts"
+    code = func.__code__
+    return frozenset(code.co_varnames[:code.co_argcount + code.co_kwonlyargcount])
+
+def _make_validator(name, func):
+    """
+    Create a validator for function messages calling func
+    The allowed keys are fixed here, so validating a message is a single set difference.
+    The validator takes (where, function message) and returns the kwargs for func.
+    """
+    allowed_keys = _arg_names(func).union(_function_keys)
+
+    def validate(where, f):
+        unexpected = f.keys() - allowed_keys
+        if unexpected:
+            raise exceptions.InvalidMessage(where, "Unexpected argument in function '{}': '{}'".format(
+                name,
+                "', '".join(sorted(unexpected))))
+        kwargs = f.copy()
+        for k in _function_keys:
+            del kwargs[k]
+        return kwargs
+
+    return validate
+
+def _build_api():
+    "Returns a read-only mapping of all registered API endpoints"
+    return types.MappingProxyType(
+        {x : (y, _make_validator(x, y)) for x, y in interface._api_endpoints.items()}) # {name : (object, validator)}
 
 class ClientHandler:
     "Handles clients"
 
-    api = {x[0] : x[1] for x in getmembers(interface, isfunction) if not x[0] in _special_functions} # {name : object}
+    api = _build_api()
+    _root_keys = ('name', 'data') # keys of a client message
+    _root_keyset = frozenset(_root_keys)
+
+    @classmethod
+    def rebuild_api(cls):
+        """
+        Include endpoints registered with interface.api_endpoint after this module was imported, e.g. by plugins
+        Must be called before the server starts serving clients.
+        """
+        cls.api = _build_api()
 
     def __init__(self, client, address):
         self._client = client
@@ -28,13 +80,26 @@ class ClientHandler:
         Send data to client
         Params:
             client -- 
-            msg -- bytes
+            msg -- bytes-like
         """
         #assert isinstance(client, ...)
-        assert isinstance(msg, bytes) 
-
-        client.sendall(msg)
-        client.sendall(constants.postfix)
+        # msg is not type checked here, sendmsg/sendall raise on non bytes-like objects anyway
+
+        # one write, so the postfix is never held back waiting for an ACK
+        postfix = constants.postfix
+        if hasattr(client, 'sendmsg'):
+            # scatter write, avoids copying msg
+            # gevent < 1.3 exposes the raw non-blocking sendmsg, which raises instead of waiting
+            # when the send buffer is full, the rest then goes through the cooperative sendall
+            try:
+                sent = client.sendmsg((msg, postfix))
+            except BlockingIOError:
+                sent = 0
+            if sent < len(msg) + len(postfix):
+                # joined instead of msg + postfix, which a memoryview doesn't support
+                client.sendall(b''.join((msg, postfix))[sent:])
+        else:
+            client.sendall(b''.join((msg, postfix)))
 
     def send(self, msg):
         """
@@ -46,44 +111,53 @@ class ClientHandler:
         """
         Parse data from client
         Params:
-            data -- data from client
+            data -- bytes-like data from client
         Returns:
-            list of (function, function_kwargs)
+            sequence of (function, function_kwargs)
         """
         where = "Message parsing"
         # TODO: log
         j_data = utils.convert_to_json(data, where)
         # {"name":name, "data":data}
-        root_keys = ('name', 'data')
-        self._check_both(where, "JSON dict", root_keys, j_data)
-               
+        root_keys = self._root_keys
+        # well-formed messages only pay for these cheap checks,
+        # the generic checks below are only used to report what is wrong
+        if not (type(j_data) is dict and j_data.keys() == self._root_keyset):
+            self._check_both(where, "JSON dict", root_keys, j_data)
+            self._expect_dict(where, j_data)
+
         # 'data': [ list of function dicts ]
-        function_keys = ('fname',)
         msg_data = j_data['data']
         if isinstance(msg_data, list):
-            function_tuples = []
-            for f in msg_data:
-                self._check_missing(where, "Function message", function_keys, f)
-
-                function_name = f['fname']
-                # check function
-                if not function_name in self.api:
-                    raise exceptions.InvalidMessage(where, "Function not found: '{}'".format(function_name))
-
-                # check parameters
-                func_args = tuple(arg for arg in f if not arg in function_keys)
-                for arg in func_args:
-                    if not arg in self.api[function_name].__code__.co_varnames:
-                        raise exceptions.InvalidMessage(where,"Unexpected argument in function '{}': '{}'".format(
-                            function_name,
-                            arg))
-
-                function_tuples.append((self.api[function_name], {x: f[x] for x in func_args}))
-
-            return function_tuples
+            # most messages call a single function
+            if len(msg_data) == 1:
+                return (self._parse_function(where, msg_data[0]),)
+            return [self._parse_function(where, f) for f in msg_data]
         else:
             raise exceptions.InvalidMessage(where, "No list of function objects found in 'data'")
 
+    def _parse_function(self, where, f):
+        """
+        Parse a function message
+        Returns:
+            (function, function_kwargs)
+        """
+        if not (type(f) is dict and 'fname' in f):
+            self._check_missing(where, "Function message", _function_keys, f)
+            self._expect_dict(where, f)
+
+        function_name = f['fname']
+        # check function
+        if type(function_name) is not str:
+            raise exceptions.InvalidMessage(where, "Function name must be a string, not: {}".format(function_name))
+        endpoint = self.api.get(function_name)
+        if endpoint is None:
+            raise exceptions.InvalidMessage(where, "Function not found: '{}'".format(function_name))
+        func, validate = endpoint
+
+        # check parameters
+        return func, validate(where, f)
+
     def _check_both(self, where, msg, keys, data):
         "Invokes both missing and unknown key"
         self._check_missing(where, msg, keys, data)
@@ -94,6 +168,10 @@ class ClientHandler:
         if len(data) != len(keys):
             self._check_required_key(where, "{} contains unknown key '{}'".format(msg, "{}"), keys, data)
 
+    def _expect_dict(self, where, data):
+        if not isinstance(data, dict):
+            raise exceptions.InvalidMessage(where, "A dict was expected, not: {}".format(data))
+
     def _expect_iterable(self, where, data):
         if not isinstance(data, (list, dict, tuple)):
             raise exceptions.InvalidMessage(where, "A list/dict was expected, not: {}".format(data))
@@ -114,17 +192,17 @@ class ClientHandler:
         """
         Advance the loop for this client
         Params:
-            buffer -- data buffer to be parsed
+            buffer -- bytes-like data buffer to be parsed
         """
         try:
             if constants.server_ready:
-                function_list = message.List("function", message.Function)
+                # same structure as a message.List of message.Function, without the wrappers
+                function_list = []
                 functions = self.parse(buffer)
                 for func, func_args in functions:
                     msg = func(**func_args)
-                    assert isinstance(msg, message.CoreMessage)
-                    function_list.append(message.Function(func.__name__, msg))
-                self.send(function_list.serialize())
+                    function_list.append({'fname':func.__name__, 'data':msg.data()})
+                self.send(message.finalize(function_list))
             else:
                 self.on_wait()
         except exceptions.CoreError as e:
@@ -140,7 +218,6 @@ class ClientHandler:
         """
         Creates and sends error message to client
         """
-        assert isinstance(exception, exceptions.CoreError)
         e = message.Error(exception.code, exception.msg)
         self.send(e.serialize())
 
@@ -157,41 +234,235 @@ class HPServer:
         self._pool = pool.Pool(constants.client_limit)
         self._server = StreamServer(params, self._handle, spawn=self._pool)
         self._web_server = None
-        self._clients = set() # a set of client handlers
+        self._clients = weakref.WeakValueDictionary() # {id : client handler}, handlers drop out when their connection ends
+        self._client_ids = itertools.count()
+        self._workers = [] # pids of forked worker processes
+        self._worker_watcher = None # greenlet reaping exited workers
+
+    def _setup_client_socket(self, client):
+        "Tune an accepted client socket for small request/response messages"
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if constants.socket_buffer_size:
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, constants.socket_buffer_size)
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, constants.socket_buffer_size)
 
     def _handle(self, client, address):
         "Client handle function"
-        # log client connected
-        print("Client connected")
+        log_d("Client connected: %s", address) # lazy formatting, skipped when debug is off
+        self._setup_client_socket(client)
         handler = ClientHandler(client, address)
-        self._clients.add(handler)
+        self._clients[next(self._client_ids)] = handler
+        postfix = constants.postfix
+        postfix_len = len(postfix)
+        data_size = constants.data_size
+        max_frame_size = constants.max_frame_size
+        # complete messages are queued and handled by a separate greenlet, so receiving continues
+        # while a message is being handled, a full queue pauses receiving
+        # one dispatcher per client keeps responses in the order of the requests
+        # the dispatcher is not spawned in self._pool, client_limit counts connections, not greenlets,
+        # and a full pool would block here while this connection holds a slot
+        frames = queue.Queue(constants.client_inflight)
+        dispatcher = gevent.spawn(self._dispatch, handler, frames)
+        # an unexpected error in the dispatcher ends the connection, instead of leaving
+        # this greenlet blocked on a full queue nobody reads from
+        receiver = gevent.getcurrent()
+        dispatcher.link_exception(lambda g: receiver.kill(block=False))
+        error = None
         try:
-            buffer = b''
+            buffer = bytearray()
+            # bytearray.find is C fastsearch (memchr for a 1-byte postfix), the buffer is
+            # modified in place so the bound method stays valid for the whole connection
+            find_postfix = buffer.find
+            scan = 0 # where to resume searching for postfix
+            # data is received into this fixed buffer, so recv doesn't allocate a new bytes object each time
+            recv_view = memoryview(bytearray(data_size))
             while True:
-                if buffer.endswith(constants.postfix):
-                    if handler.is_active():
-                        handler.advance(buffer)
-                    else:
-                        # log client disconnected
-                        break
-                    buffer = b''
-                r = client.recv(constants.data_size)
-                if not r:
+                n = client.recv_into(recv_view)
+                if not n:
                     # log client disconnected
                     break
-                else:
-                    buffer += r
+                buffer.extend(recv_view[:n])
+
+                # queue every complete message in the buffer
+                idx = find_postfix(postfix, scan)
+                while idx != -1 and handler.is_active() and not dispatcher.dead:
+                    # the slice is the one copy needed, a bytearray is accepted by all json decoders
+                    frames.put(buffer[:idx])
+                    del buffer[:idx + postfix_len]
+                    idx = find_postfix(postfix)
+                if not handler.is_active() or dispatcher.dead:
+                    # log client disconnected
+                    break
+                # only the incomplete message left in the buffer counts against the limit,
+                # it may end with a partial postfix
+                if len(buffer) > max_frame_size + postfix_len:
+                    error = exceptions.InvalidMessage(
+                        "Message receiving", "Message exceeds max size of {} bytes".format(max_frame_size))
+                    break
+                # only the tail that could hold a partial postfix needs to be searched again
+                scan = max(0, len(buffer) - postfix_len + 1)
         except socket.error as e:
-            # log error
-            utils.eprint("Client disconnected", e)
+            log_d("Client connection error: %s", e)
+        finally:
+            # let the dispatcher finish the queued messages
+            if not dispatcher.dead:
+                frames.put(StopIteration)
+                dispatcher.join()
+        if error:
+            try:
+                handler.on_error(error)
+            except socket.error:
+                pass
+        log_d("Client disconnected: %s", address)
+
+    def _dispatch(self, handler, frames):
+        "Pass queued messages to the client handler in order, until StopIteration is queued"
+        try:
+            for frame in frames:
+                handler.advance(frame)
+        except socket.error as e:
+            log_d("Client connection error: %s", e)
+            # discard the rest so the receiving greenlet never blocks on a full queue
+            for frame in frames:
+                pass
+
+    def _listener(self, params):
+        "Create a listening socket that can share its port with the sockets of other worker processes"
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(params)
+        sock.listen(StreamServer.backlog or socket.SOMAXCONN)
+        return sock
+
+    def _check_port_free(self, params):
+        """
+        Raise socket.error if the port is already in use
+        SO_REUSEPORT would otherwise let another running instance silently share the port.
+        """
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # SO_REUSEADDR like StreamServer, so connections of a previous run in TIME_WAIT don't count
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.bind(params) # without SO_REUSEPORT, a listening socket still makes this fail
         finally:
-            self._clients.remove(handler)
-        print(client, " disconnected")
+            probe.close()
+
+    def _spawn_workers(self, workers):
+        """
+        Fork worker processes that accept connections on their own SO_REUSEPORT socket
+        The kernel then distributes incoming connections between the processes.
+        Worker processes never return from this method.
+        Params:
+            workers -- total amount of server processes, including this one
+        """
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            utils.eprint("Warning: SO_REUSEPORT is not supported on this platform, starting only one server process")
+            return
+
+        params = utils.connection_params()
+        self._check_port_free(params)
+        client_limit = max(1, constants.client_limit // workers) if constants.client_limit else None
+        parent_pid = os.getpid()
+        for n in range(workers - 1):
+            pid = os.fork()
+            if pid == 0:
+                self._worker_main(params, client_limit, parent_pid)
+            self._workers.append(pid)
+
+        signal.signal(signal.SIGTERM, self._on_terminate)
+        self._worker_watcher = gevent.spawn(self._watch_workers)
+        self._pool = pool.Pool(client_limit)
+        self._server = StreamServer(self._listener(params), self._handle, spawn=self._pool)
+
+    def _worker_main(self, params, client_limit, parent_pid):
+        "Run a forked worker process, exits non-zero if the worker failed"
+        # shares nothing with the parent except the database
+        status = 1
+        try:
+            self._workers = []
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self._pool = pool.Pool(client_limit)
+            self._server = StreamServer(self._listener(params), self._handle, spawn=self._pool)
+            db.connect() # own connection, the parent already set up the database and recorded the start
+            gevent.spawn(self._watch_parent, parent_pid)
+            self._server.serve_forever()
+            status = 0
+        except Exception as e:
+            utils.eprint("Error: Server worker process failed:", e)
+        finally:
+            os._exit(status)
+
+    def _watch_parent(self, parent_pid):
+        "Stop serving when the parent process is gone, so a worker is never left orphaned"
+        while os.getppid() == parent_pid:
+            gevent.sleep(1)
+        self._server.stop()
+
+    def _watch_workers(self):
+        "Periodically reap worker processes that exited"
+        while self._workers:
+            gevent.sleep(1)
+            self._reap_workers()
+
+    def _reap_workers(self, report=True):
+        """
+        Reap worker processes that exited
+        Params:
+            report -- print an error for workers that didn't exit successfully
+        """
+        for pid in list(self._workers):
+            try:
+                exited_pid, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                exited_pid, status = pid, 0 # already reaped
+            if exited_pid:
+                self._workers.remove(pid)
+                if report and not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+                    utils.eprint("Error: Server worker process {} exited unexpectedly (status: {})".format(pid, status))
+
+    def _on_terminate(self, signum, frame):
+        "SIGTERM handler of the parent process, the workers are stopped when run() unwinds"
+        raise SystemExit(0)
+
+    def _stop_workers(self, timeout=5):
+        "Terminate forked worker processes and wait for them to exit"
+        if self._worker_watcher:
+            self._worker_watcher.kill(block=False)
+            self._worker_watcher = None
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.monotonic() + timeout
+        while self._workers and time.monotonic() < deadline:
+            self._reap_workers(report=False)
+            if self._workers:
+                gevent.sleep(0.1)
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._workers.clear()
 
     def _start(self, blocking=True):
         # TODO: handle db errors
 
+        ClientHandler.rebuild_api()
+        # initialized before forking, so worker processes don't race each other creating the schema
         db.init()
+        workers = constants.server_workers or os.cpu_count() or 1
+        try:
+            if workers > 1:
+                self._spawn_workers(workers)
+        except (socket.error, OSError) as e:
+            # log error
+            utils.eprint("Error: Failed to start server worker processes (Port might already be in use)", e)
+            self._stop_workers()
+            return
 
         try:
             if blocking:
@@ -210,26 +481,28 @@ class HPServer:
             web -- Start the web server
             interactive -- Start in interactive mode (Note: Does not work with web server)
         """
-        self._start(not (web or interactive))
-
-        if web:
-            # start webserver
-            try:
-                print("Web server successfully starting... (Port: {}) {}".format(constants.web_port, "(blocking)" if not interactive else ""))
-                # OBS: will trigger a harmless socket.error when debug=True (stuff still works)
-                hweb.socketio.run(hweb.happyweb, *utils.connection_params(web=True), block=not interactive, debug=constants.debug)
-                # log
-                print("Web server successfully started (Port: {})".format(constants.web_port))
-            except (socket.error, OSError) as e:
-                # log error
-                utils.eprint("Error: Failed to start web server (Port might already be in use)") #include e
+        try:
+            self._start(not (web or interactive))
+
+            if web:
+                # start webserver
+                try:
+                    print("Web server successfully starting... (Port: {}) {}".format(constants.web_port, "(blocking)" if not interactive else ""))
+                    # OBS: will trigger a harmless socket.error when debug=True (stuff still works)
+                    hweb.socketio.run(hweb.happyweb, *utils.connection_params(web=True), block=not interactive, debug=constants.debug)
+                    # log
+                    print("Web server successfully started (Port: {})".format(constants.web_port))
+                except (socket.error, OSError) as e:
+                    # log error
+                    utils.eprint("Error: Failed to start web server (Port might already be in use)") #include e
         
 
-        if interactive:
-            interface.interactive()
-
-        # log server shutduown
-        print("Server shutting down.")
+            if interactive:
+                interface.interactive()
+        finally:
+            # log server shutduown
+            print("Server shutting down.")
+            self._stop_workers()
 
 if __name__ == '__main__':
     server = HPServer()
@@ -1,2 +1,12 @@
 from gevent import monkey
 monkey.patch_all() # necessary to make these functions play nice with gevent
+
+_api_endpoints = {} # {name : function}
+def api_endpoint(func):
+    "Register func as a function callable by clients"
+    assert func.__name__ not in _api_endpoints, "API endpoint already registered"
+    _api_endpoints[func.__name__] = func
+    return func
+
+# import modules containing endpoints so they get registered
+from happypanda.server.interface import gallery # noqa: E402,F401
@@ -1,5 +1,39 @@
+import functools
+
 from happypanda.common import constants, message
+from happypanda.server.interface import api_endpoint
+
+# shared by all stub endpoints, callers must not modify it (e.g. with set_error)
+_WORKS = message.Message("works")
+
+def _cached_call(func, *args):
+    """
+    Call a lru_cache'd function, unhashable args bypass the cache
+    The cache is per process and can't be invalidated in other worker processes,
+    so it is only used when running a single server process.
+    """
+    if constants.server_workers != 1:
+        return func.__wrapped__(*args)
+    try:
+        hash(args)
+    except TypeError:
+        return func.__wrapped__(*args)
+    return func(*args)
+
+def _clear_view_cache():
+    "Invalidate cached results of the read-only endpoints, call when galleries change"
+    _fetch_galleries.cache_clear()
+    _gallery_view.cache_clear()
+
+@functools.lru_cache(maxsize=1024)
+def _fetch_galleries(gallery_ids):
+    return _WORKS
+
+@functools.lru_cache(maxsize=1024)
+def _gallery_view(page, gallery_limit, search_filter, list_id, gallery_filter):
+    return _WORKS
 
+@api_endpoint
 def fetch_galleries(gallery_ids=[]):
     """
     Fetch galleries from the database.
@@ -10,8 +44,11 @@ def fetch_galleries(gallery_ids=[]):
     Returns:
         list of gallery message objects
     """
-    return message.Message("works")
+    if isinstance(gallery_ids, list):
+        gallery_ids = tuple(gallery_ids)
+    return _cached_call(_fetch_galleries, gallery_ids)
 
+@api_endpoint
 def gallery_view(page=0, gallery_limit=100, search_filter="", list_id=0, gallery_filter=constants.GalleryFilter):
     """
     Fetch galleries from the database.
@@ -28,8 +65,9 @@ def gallery_view(page=0, gallery_limit=100, search_filter="", list_id=0, gallery
         list of gallery message objects
     """
 
-    return message.Message("works")
+    return _cached_call(_gallery_view, page, gallery_limit, search_filter, list_id, gallery_filter)
 
+@api_endpoint
 def add_gallery(galleries=[], paths=[]):
     """
     Add galleries to the database.
@@ -45,8 +83,10 @@ def add_gallery(galleries=[], paths=[]):
     Returns:
         Gallery objects
     """
-    return message.Message("works")
+    _clear_view_cache()
+    return _WORKS
 
+@api_endpoint
 def scan_gallery(paths=[], add_after=False, ignore_exist=True):
     """
     Scan folders for galleries
@@ -59,4 +99,6 @@ def scan_gallery(paths=[], add_after=False, ignore_exist=True):
     Returns:
         list of paths to the galleries
     """
-    return message.Message("works")
\ No newline at end of file
+    if add_after:
+        _clear_view_cache()
+    return _WORKS
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""test interface modules."""
+from unittest import mock
+
+import pytest
+
+from happypanda.common import constants
+from happypanda.server.interface import gallery
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """start every test with empty caches."""
+    gallery._clear_view_cache()
+    yield
+    gallery._clear_view_cache()
+
+
+def test_gallery_view_cached():
+    """test repeated gallery_view calls are served from the cache."""
+    assert gallery.gallery_view(page=1) is gallery.gallery_view(page=1)
+    info = gallery._gallery_view.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    gallery.gallery_view(page=2)
+    assert gallery._gallery_view.cache_info().misses == 2
+
+
+def test_fetch_galleries_cached():
+    """test fetch_galleries caches list arguments."""
+    gallery.fetch_galleries(gallery_ids=[1, 2])
+    gallery.fetch_galleries(gallery_ids=[1, 2])
+    assert gallery._fetch_galleries.cache_info().hits == 1
+
+
+def test_unhashable_args_bypass_cache():
+    """test unhashable arguments skip the cache."""
+    gallery.gallery_view(search_filter=['unhashable'])
+    info = gallery._gallery_view.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (0, 0, 0)
+
+
+@pytest.mark.parametrize('func, kwargs, clears', [
+    (gallery.add_gallery, {}, True),
+    (gallery.scan_gallery, {'add_after': True}, True),
+    (gallery.scan_gallery, {'add_after': False}, False),
+])
+def test_cache_invalidation(func, kwargs, clears):
+    """test endpoints adding galleries invalidate the cache."""
+    gallery.gallery_view()
+    gallery.fetch_galleries()
+    func(**kwargs)
+    assert gallery._gallery_view.cache_info().currsize == (0 if clears else 1)
+    assert gallery._fetch_galleries.cache_info().currsize == (0 if clears else 1)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_no_cache_with_workers(workers):
+    """test the per-process cache is not used with several server processes."""
+    with mock.patch.object(constants, 'server_workers', workers):
+        gallery.gallery_view()
+        gallery.gallery_view()
+        gallery.fetch_galleries()
+    assert gallery._gallery_view.cache_info().currsize == 0
+    assert gallery._fetch_galleries.cache_info().currsize == 0
@@ -0,0 +1,30 @@
+"""test message module."""
+from unittest import mock
+import json
+
+import pytest
+
+from happypanda.common import message
+
+
+@pytest.mark.parametrize('msg_dict', [
+    {'msg': 'works'},
+    [{'fname': 'gallery_view', 'data': 'works'}],
+    {1: 2, 'nested': {3: [4, 5]}},
+    {'big': 2 ** 70},
+])
+def test_finalize(msg_dict):
+    """test finalize gives the same payload with orjson (when installed) and json."""
+    expected = json.loads(json.dumps({'name': 'test', 'data': msg_dict}))
+    with mock.patch.object(message, 'orjson', None):
+        assert json.loads(message.finalize(msg_dict, name='test').decode('utf-8')) == expected
+    assert json.loads(message.finalize(msg_dict, name='test').decode('utf-8')) == expected
+
+
+def test_finalize_nan():
+    """test finalize sends NaN as null with orjson and as NaN with json."""
+    msg_dict = {'a': float('nan')}
+    with mock.patch.object(message, 'orjson', None):
+        assert message.finalize(msg_dict, name='test') == b'{"name": "test", "data": {"a": NaN}}'
+    if message.orjson:
+        assert json.loads(message.finalize(msg_dict, name='test').decode('utf-8'))['data'] == {'a': None}
@@ -1,11 +1,15 @@
 """test server module."""
 from unittest import mock
 import itertools
+import json
 
 from gevent import socket
 import pytest
 
-from happypanda.server.core.server import HPServer
+from happypanda.common import constants, exceptions, message
+from happypanda.server import interface
+from happypanda.server.core import server, db
+from happypanda.server.core.server import HPServer, ClientHandler
 
 
 @pytest.mark.parametrize('is_public_server', [True, False])
@@ -37,7 +41,7 @@ def test_init(is_public_server):
             )
         hps._server == m_stream_server.return_value
         assert hps._web_server is None
-        assert hps._clients == set()
+        assert len(hps._clients) == 0
 
 
 @mock.patch('happypanda.core.server.print')
@@ -135,3 +139,328 @@ def test_handle(recv_first_val):
                     mock.call('Client connected'),
                     mock.call('Client disconnected', mock.ANY)
                 ], any_order=True)
+
+
+class FakeClient:
+    """client socket whose recv_into returns scripted chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = b''
+
+    def setsockopt(self, *args):
+        pass
+
+    def recv_into(self, view):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def sendall(self, data):
+        self.sent += data
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    # several frames in one recv
+    ([b'{"a": 1}end{"b": 2}end{"c": 3}end'], [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}']),
+    # postfix split across recvs
+    ([b'{"a": 1}e', b'nd{"b": 2}en', b'd'], [b'{"a": 1}', b'{"b": 2}']),
+    ([b'{"a": 1}', b'e', b'n', b'dend'], [b'{"a": 1}', b'']),
+    # incomplete frame is not dispatched
+    ([b'{"a": 1}end{"b"'], [b'{"a": 1}']),
+])
+def test_handle_framing(chunks, expected):
+    """test _handle dispatches every complete frame."""
+    with mock.patch('happypanda.server.core.server.ClientHandler.advance') as m_advance:
+        hps = HPServer()
+        hps._handle(FakeClient(chunks), ('localhost', 0))
+    assert [bytes(c[0][0]) for c in m_advance.call_args_list] == expected
+
+
+@pytest.mark.parametrize('chunks, expected, rejected', [
+    ([b'{"a": 1}end', b'x' * 20, b'x' * 20, b'end'], [b'{"a": 1}'], True),
+    # a recv finishing one frame and starting the next, both under the limit
+    ([b'x' * 20, b'x' * 7 + b'end' + b'y' * 10, b'y' * 12 + b'end'], [b'x' * 27, b'y' * 22], False),
+])
+def test_handle_max_frame_size(chunks, expected, rejected):
+    """test _handle rejects a message exceeding max_frame_size."""
+    client = FakeClient(chunks)
+    with mock.patch('happypanda.server.core.server.ClientHandler.advance') as m_advance, \
+            mock.patch.object(constants, 'max_frame_size', 30):
+        hps = HPServer()
+        hps._handle(client, ('localhost', 0))
+    assert [bytes(c[0][0]) for c in m_advance.call_args_list] == expected
+    if rejected:
+        assert b'exceeds max size' in client.sent
+        assert client.sent.endswith(constants.postfix)
+    else:
+        assert client.sent == b''
+
+
+def _ping():
+    """test endpoint."""
+    return message.Message('pong')
+
+
+def test_handle_invalid_json():
+    """test _handle replies with an error to a malformed message and keeps serving."""
+    client = FakeClient([b'{bad}end{"name": "test", "data": [{"fname": "ping"}]}end'])
+    with mock.patch.dict(interface._api_endpoints, {'ping': _ping}, clear=True), \
+            mock.patch.object(ClientHandler, 'api', server._build_api()), \
+            mock.patch.object(constants, 'server_ready', True):
+        hps = HPServer()
+        hps._handle(client, ('localhost', 0))
+    error, reply = client.sent.split(constants.postfix)[:2]
+    assert json.loads(error.decode())['data']['error']['code'] == exceptions.JSONParseError.code
+    assert json.loads(reply.decode())['data'] == [{'fname': '_ping', 'data': 'pong'}]
+
+
+def test_spawn_workers():
+    """test _spawn_workers forks the workers and stays in the parent."""
+    with mock.patch('happypanda.server.core.server.os.fork', side_effect=[101, 102]) as m_fork, \
+            mock.patch('happypanda.server.core.server.signal.signal') as m_signal, \
+            mock.patch('happypanda.server.core.server.gevent.spawn'), \
+            mock.patch('happypanda.server.core.server.StreamServer'), \
+            mock.patch.object(HPServer, '_listener'), \
+            mock.patch.object(HPServer, '_check_port_free') as m_check_port:
+        hps = HPServer()
+        hps._spawn_workers(3)
+    assert m_fork.call_count == 2
+    assert hps._workers == [101, 102]
+    m_check_port.assert_called_once_with(server.utils.connection_params())
+    m_signal.assert_called_once_with(server.signal.SIGTERM, hps._on_terminate)
+
+
+@pytest.mark.parametrize('fail, status', [(True, 1), (False, 0)])
+def test_worker_exit_status(fail, status):
+    """test a worker process exits non-zero when it fails."""
+    with mock.patch('happypanda.server.core.server.os._exit', side_effect=SystemExit) as m_exit, \
+            mock.patch('happypanda.server.core.server.signal.signal'), \
+            mock.patch('happypanda.server.core.server.gevent.spawn'), \
+            mock.patch('happypanda.server.core.server.db'), \
+            mock.patch('happypanda.server.core.server.utils.eprint'), \
+            mock.patch('happypanda.server.core.server.StreamServer') as m_stream_server, \
+            mock.patch.object(HPServer, '_listener'):
+        hps = HPServer()
+        if fail:
+            m_stream_server.return_value.serve_forever.side_effect = socket.error
+        with pytest.raises(SystemExit):
+            hps._worker_main(('', 0), None, 1)
+    m_exit.assert_called_once_with(status)
+
+
+def test_worker_leaves_db_start_unrecorded(tmp_path, monkeypatch):
+    """test starting a worker process doesn't record another start in the database."""
+    monkeypatch.chdir(tmp_path)
+    with mock.patch.object(constants, 'db_path', 'test.db'), \
+            mock.patch.object(constants, 'debug', False), \
+            mock.patch.object(constants, 'db_session', None):
+        db.init()
+        parent_session = constants.db_session
+        with mock.patch('happypanda.server.core.server.os._exit', side_effect=SystemExit), \
+                mock.patch('happypanda.server.core.server.signal.signal'), \
+                mock.patch('happypanda.server.core.server.gevent.spawn'), \
+                mock.patch('happypanda.server.core.server.StreamServer'), \
+                mock.patch.object(HPServer, '_listener'):
+            hps = HPServer()
+            with pytest.raises(SystemExit):
+                hps._worker_main(('', 0), None, 1)
+        assert constants.db_session is not parent_session
+        sess = constants.db_session()
+        assert sess.query(db.Life).one().times_opened == 1
+        assert sess.query(db.History).count() == 1
+        sess.close()
+
+
+def test_check_port_free():
+    """test _check_port_free fails when the port is in use, but not after the server stopped."""
+    hps = HPServer()
+    sock = server.socket.socket(server.socket.AF_INET, server.socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(server.socket.SOL_SOCKET, server.socket.SO_REUSEPORT, 1)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        with pytest.raises(OSError):
+            hps._check_port_free(sock.getsockname())
+    finally:
+        sock.close()
+    hps._check_port_free(('127.0.0.1', 0))
+
+    # connections of a stopped server in TIME_WAIT don't count
+    sock = server.socket.socket(server.socket.AF_INET, server.socket.SOCK_STREAM)
+    sock.setsockopt(server.socket.SOL_SOCKET, server.socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    params = sock.getsockname()
+    client = server.socket.create_connection(params)
+    accepted, _ = sock.accept()
+    # the side closing first holds the TIME_WAIT state
+    accepted.close()
+    client.recv(1)
+    client.close()
+    sock.close()
+    hps._check_port_free(params)
+
+
+def test_reap_workers():
+    """test _reap_workers removes exited workers and reports failed ones."""
+    waitpid = {101: (0, 0), 102: (102, 0), 103: (103, 1 << 8)}
+    with mock.patch('happypanda.server.core.server.os.waitpid', side_effect=lambda pid, opt: waitpid[pid]), \
+            mock.patch('happypanda.server.core.server.utils.eprint') as m_eprint:
+        hps = HPServer()
+        hps._workers = [101, 102, 103]
+        hps._reap_workers()
+    assert hps._workers == [101]
+    m_eprint.assert_called_once()
+    assert '103' in m_eprint.call_args[0][0]
+
+
+def test_stop_workers():
+    """test _stop_workers terminates and reaps every worker."""
+    with mock.patch('happypanda.server.core.server.os.kill') as m_kill, \
+            mock.patch('happypanda.server.core.server.os.waitpid', side_effect=lambda pid, opt: (pid, 0)):
+        hps = HPServer()
+        hps._workers = [101, 102]
+        hps._stop_workers()
+    m_kill.assert_has_calls([mock.call(101, server.signal.SIGTERM), mock.call(102, server.signal.SIGTERM)])
+    assert hps._workers == []
+
+
+def test_run_stops_workers_on_error():
+    """test run stops the workers when it exits with an exception."""
+    with mock.patch.object(HPServer, '_start', side_effect=RuntimeError), \
+            mock.patch.object(HPServer, '_stop_workers') as m_stop_workers:
+        hps = HPServer()
+        with pytest.raises(RuntimeError):
+            hps.run()
+    m_stop_workers.assert_called_once_with()
+
+
+class FakeSendmsgClient:
+    """client socket whose sendmsg writes a scripted amount of bytes."""
+
+    def __init__(self, sendmsg_results):
+        self.sendmsg_results = list(sendmsg_results)
+        self.sent = b''
+
+    def sendmsg(self, buffers):
+        result = self.sendmsg_results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        self.sent += b''.join(buffers)[:result]
+        return result
+
+    def sendall(self, data):
+        self.sent += data
+
+
+@pytest.mark.parametrize('msg', [b'message', bytearray(b'message'), memoryview(b'message')])
+@pytest.mark.parametrize('sendmsg_result', [10, 7, 4, 2, 0, BlockingIOError()])
+def test_sendall(sendmsg_result, msg):
+    """test sendall sends the whole message and postfix despite partial or failed sendmsg."""
+    client = FakeSendmsgClient([sendmsg_result])
+    ClientHandler.sendall(client, msg)
+    assert client.sent == b'message' + constants.postfix
+
+
+@pytest.mark.parametrize('msg', [b'message', bytearray(b'message'), memoryview(b'message')])
+def test_sendall_without_sendmsg(msg):
+    """test sendall on a socket without sendmsg."""
+    client = mock.Mock(spec=['sendall'])
+    ClientHandler.sendall(client, msg)
+    client.sendall.assert_called_once_with(b'message' + constants.postfix)
+
+
+def _view(page=0, limit=10):
+    """test endpoint."""
+
+
+def _flagged(*, flag=False):
+    """test endpoint with a kw-only argument."""
+
+
+@pytest.fixture
+def handler():
+    """client handler with test endpoints."""
+    endpoints = {'view': _view, 'flagged': _flagged}
+    with mock.patch.dict(interface._api_endpoints, endpoints, clear=True):
+        with mock.patch.object(ClientHandler, 'api', server._build_api()):
+            yield ClientHandler(None, None)
+
+
+def test_parse_single_function(handler):
+    """test parse with a single function message."""
+    res = handler.parse(b'{"name": "test", "data": [{"fname": "view", "page": 2}]}end')
+    assert list(res) == [(_view, {'page': 2})]
+
+
+def test_parse_multiple_functions(handler):
+    """test parse with several function messages."""
+    res = handler.parse(b'{"name": "test", "data": [{"fname": "view"}, {"fname": "view", "limit": 5}]}')
+    assert list(res) == [(_view, {}), (_view, {'limit': 5})]
+
+
+def test_parse_kwonly_argument(handler):
+    """test parse accepts kw-only arguments."""
+    res = handler.parse(b'{"name": "test", "data": [{"fname": "flagged", "flag": true}]}')
+    assert list(res) == [(_flagged, {'flag': True})]
+
+
+@pytest.mark.parametrize('data, error', [
+    # unknown arguments, listed sorted
+    (b'{"name": "test", "data": [{"fname": "view", "zz": 1, "aa": 2}]}',
+     "Unexpected argument in function 'view': 'aa', 'zz'"),
+    # unknown function
+    (b'{"name": "test", "data": [{"fname": "nope"}]}', "Function not found: 'nope'"),
+    # non-str function name
+    (b'{"name": "test", "data": [{"fname": ["x"]}]}', "Function name must be a string"),
+    (b'{"name": "test", "data": [{"fname": {"x": 1}}]}', "Function name must be a string"),
+    # non-dict root
+    (b'["name", "data"]', "A dict was expected"),
+    (b'"name"', "A list/dict was expected"),
+    (b'{"name": "test"}', "JSON dict missing 'data' key"),
+    (b'{"name": "test", "data": [], "other": 1}', "JSON dict contains unknown key 'other'"),
+    # non-dict function message
+    (b'{"name": "test", "data": [["fname"]]}', "A dict was expected"),
+    (b'{"name": "test", "data": [1]}', "A list/dict was expected"),
+    (b'{"name": "test", "data": [{"page": 1}]}', "Function message missing 'fname' key"),
+    # data is not a list
+    (b'{"name": "test", "data": {"fname": "view"}}', "No list of function objects found in 'data'"),
+])
+def test_parse_invalid(handler, data, error):
+    """test parse rejects invalid messages."""
+    with pytest.raises(exceptions.InvalidMessage) as excinfo:
+        handler.parse(data)
+    assert error in excinfo.value.msg
+
+
+def test_api_read_only():
+    """test the api mapping rejects item assignment."""
+    with pytest.raises(TypeError):
+        ClientHandler.api['view'] = (_view, None)
+
+
+def test_rebuild_api(monkeypatch):
+    """test endpoints registered after import are callable only after rebuild_api."""
+    monkeypatch.setattr(ClientHandler, 'api', ClientHandler.api)
+    with mock.patch.dict(interface._api_endpoints):
+        interface.api_endpoint(_view)
+        handler = ClientHandler(None, None)
+        with pytest.raises(exceptions.InvalidMessage):
+            handler.parse(b'{"name": "test", "data": [{"fname": "_view"}]}')
+        ClientHandler.rebuild_api()
+        res = handler.parse(b'{"name": "test", "data": [{"fname": "_view"}]}')
+    assert list(res) == [(_view, {})]
+
+
+def test_api_only_registered_endpoints(monkeypatch):
+    """test functions that are only imported into the interface modules are not exposed."""
+    monkeypatch.setattr(ClientHandler, 'api', ClientHandler.api)
+    monkeypatch.setattr(interface, '_flagged', _flagged, raising=False)
+    ClientHandler.rebuild_api()
+    assert 'api_endpoint' not in ClientHandler.api # imported by interface.gallery
+    assert '_flagged' not in ClientHandler.api
+    assert 'gallery_view' in ClientHandler.api
+    assert ClientHandler.api.keys() == interface._api_endpoints.keys()
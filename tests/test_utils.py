@@ -1,7 +1,12 @@
 """test utils module."""
 from unittest import mock
+import logging
+import queue
 
-from happypanda.common.utils import eprint
+import pytest
+
+from happypanda.common import constants, exceptions, utils
+from happypanda.common.utils import eprint, convert_to_json
 
 
 @mock.patch('happypanda.common.utils.print')
@@ -15,3 +20,50 @@ def test_eprint(m_sys, m_print):
     kwargs_input = {m_key: m_value}
     eprint(*args_input, **kwargs_input)
     m_print.assert_called_once_with(m_arg, file=m_sys.stderr, **kwargs_input)
+
+
+@pytest.mark.parametrize('buffer', [
+    b'{"name": "test"}end',
+    b'{"name": "test"}',
+    bytearray(b'{"name": "test"}'),
+    memoryview(b'{"name": "test"}end'),
+])
+def test_convert_to_json(buffer):
+    """test convert_to_json."""
+    assert convert_to_json(buffer, 'test') == {'name': 'test'}
+
+
+def test_convert_to_json_invalid():
+    """test convert_to_json with invalid data."""
+    with pytest.raises(exceptions.JSONParseError) as excinfo:
+        convert_to_json(b'{"name": end', 'test')
+    assert excinfo.value.where == 'test'
+    assert excinfo.value.msg.startswith('Failed parsing json data')
+
+
+def test_setup_logger():
+    """test setup_logger only configures the root logger once, with a bounded queue."""
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    with mock.patch.object(utils, '_log_listener', None), \
+            mock.patch.object(utils.atexit, 'register'):
+        listener = utils.setup_logger()
+        try:
+            assert utils.setup_logger() is listener
+            added = [h for h in root.handlers if h not in handlers]
+            assert len(added) == 1
+            assert added[0].queue.maxsize == constants.log_queue_size
+        finally:
+            listener.stop()
+            root.handlers = handlers
+
+
+def test_setup_logger_full_queue():
+    """test records are dropped when the log queue is full."""
+    handler = utils._DroppingQueueHandler(queue.Queue(1))
+    record = logging.makeLogRecord({'msg': 'test'})
+    handler.enqueue(record)
+    with mock.patch.object(handler, 'handleError') as m_handle_error:
+        handler.enqueue(record)
+    m_handle_error.assert_not_called()
+    assert handler.queue.qsize() == 1